@@ -5,9 +5,21 @@ Major chunks include:
   fetch: Responsible for interactions with the Slack API, like downloading messages and fetching
     user information.
   export: Responsible for taking the objects retrieved by fetch and excreting them into zip files.
+  msgindex: A compact, array-backed index of an archive's messages, their replies and users.
+  estimate: Sizes up archive requests before they're run, to decide whether to run them.
   ui: Holds prewritten Slack UI blocks to send as messages.
+  profiling: Opt-in CPU, memory and Slack API profiling of individual archive jobs.
+  jobstore: A SQLite queue of archive jobs, shared by every worker process.
+  expire: Deletes old archives from the S3 bucket, in batches.
+  checkpoint: Persists archive job progress to disk, so jobs can resume after a restart.
 """
 
 from . import fetch
 from . import export
+from . import msgindex
 from . import ui
+from . import estimate
+from . import checkpoint
+from . import expire
+from . import jobstore
+from . import profiling
@@ -0,0 +1,226 @@
+"""
+carmille.checkpoint: Persists the progress of archive jobs to local disk, so that a job
+interrupted by a crash or a restart can pick up where it left off.
+
+Each job gets its own directory under CHECKPOINT_DIR, containing:
+  state.json: the job's parameters and how far it has gotten.
+  history.jsonl: one line per page of conversations.history results.
+  threads.jsonl: one line per completed thread expansion, written in batches.
+
+The counts in state.json are the source of truth; any lines past those counts in the
+.jsonl files were written just before a crash and are ignored on resume.
+"""
+
+import glob
+import json
+import logging
+import os
+import shutil
+import uuid
+
+CHECKPOINT_DIR = "data/jobs"
+# Where carmille.export builds archives, in per-job export_dir directories and zip files.
+EXPORT_TMP_DIR = "tmp"
+
+
+def new_job(team_id, enterprise_id, is_enterprise_install, response_url, channel_id, channel_name, start_epoch, end_epoch, tz_offset, low_priority=False, profile=False):
+    """
+    Create and persist a new archive job. Returns the job dict.
+
+    team_id, enterprise_id, is_enterprise_install: identify the installation, so we can
+        find a bot token again after a restart.
+    response_url: where to tell the requesting user about the finished archive.
+    channel_id: the human-opaque Slack channel identifier.
+    channel_name: the human-readable Slack channel name.
+    start_epoch, end_epoch: the archive window, in Unix seconds.
+    tz_offset: the requesting user's local time offset from UTC, in integer seconds.
+    low_priority: True if the job was sent to the low-priority lane for being big.
+    profile: True if the job should be run with carmille.profiling.
+    """
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'team_id': team_id,
+        'enterprise_id': enterprise_id,
+        'is_enterprise_install': is_enterprise_install,
+        'response_url': response_url,
+        'channel_id': channel_id,
+        'channel_name': channel_name,
+        'start_epoch': start_epoch,
+        'end_epoch': end_epoch,
+        'tz_offset': tz_offset,
+        'low_priority': low_priority,
+        'profile': profile,
+        # Fetch progress
+        'history_pages': 0,
+        'history_bytes': 0,
+        'history_cursor': None,
+        'history_done': False,
+        'threads_done': 0,
+        'threads_bytes': 0,
+        # Export progress
+        'export_dir': None,
+        'json_done': False,
+        'html_messages': 0,
+        'html_offset': 0,
+        'html_done': False,
+        'zip_done': False,
+        'archive_url': None,
+        # Progressive delivery
+        'published_until': 0,
+        'progress_updates': 0,
+        'last_progress_update': 0,
+    }
+    os.makedirs(__job_dir(job), exist_ok=True)
+    save(job)
+    return job
+
+
+def save(job):
+    """
+    Atomically write a job's state to disk.
+
+    job: a job dict as made by new_job.
+    """
+    path = os.path.join(__job_dir(job), "state.json")
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(job, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f"{path}.tmp", path)
+
+
+def finish(job):
+    """
+    Throw away a job's checkpoint, because it's done (or can never be done).
+
+    job: a job dict as made by new_job.
+    """
+    shutil.rmtree(__job_dir(job), ignore_errors=True)
+    # A job that gave up partway through exporting leaves its files in tmp, too.
+    if job.get('export_dir'):
+        shutil.rmtree(os.path.join(EXPORT_TMP_DIR, job['export_dir']), ignore_errors=True)
+        for path in glob.glob(os.path.join(EXPORT_TMP_DIR, f"{glob.escape(job['export_dir'])}_*.zip")):
+            try:
+                os.remove(path)
+            except OSError as errormessage:
+                logging.error(f"Couldn't remove {path} for job {job['job_id']}: {errormessage}")
+
+
+def load(job_id):
+    """
+    Load one job's state from disk. Returns the job dict, or None if it isn't there.
+
+    job_id: the job's job_id.
+    """
+    try:
+        with open(os.path.join(CHECKPOINT_DIR, job_id, "state.json")) as file:
+            return json.load(file)
+    except (OSError, ValueError) as errormessage:
+        logging.error(f"Couldn't load checkpoint for job {job_id}: {errormessage}")
+        return None
+
+
+def load_pending():
+    """
+    Find every job that was checkpointed but never finished.
+    Returns an array of job dicts.
+    """
+    jobs = []
+    if not os.path.isdir(CHECKPOINT_DIR):
+        return jobs
+    for job_id in os.listdir(CHECKPOINT_DIR):
+        path = os.path.join(CHECKPOINT_DIR, job_id, "state.json")
+        try:
+            with open(path) as file:
+                jobs.append(json.load(file))
+        except (OSError, ValueError) as errormessage:
+            logging.error(f"Couldn't load checkpoint for job {job_id}: {errormessage}")
+    return jobs
+
+
+def record_history_page(job, messages, next_cursor, done):
+    """
+    Persist one page of conversations.history results.
+
+    job: a job dict as made by new_job.
+    messages: the array of message dicts in this page.
+    next_cursor: the cursor to fetch the next page with.
+    done: True if this was the last page.
+    """
+    job['history_bytes'] = __append_lines(job, "history.jsonl", job['history_bytes'], [messages])
+    job['history_pages'] += 1
+    job['history_cursor'] = next_cursor
+    job['history_done'] = done
+    save(job)
+
+
+def load_history(job):
+    """
+    Returns every message from the checkpointed history pages, as one array.
+
+    job: a job dict as made by new_job.
+    """
+    messages = []
+    for page in __read_lines(job, "history.jsonl", job['history_pages']):
+        messages.extend(page)
+    return messages
+
+
+def record_threads(job, threads):
+    """
+    Persist a batch of completed thread expansions, with one sync to disk for the lot.
+
+    job: a job dict as made by new_job.
+    threads: an array of (timestamp, replies) tuples, where timestamp is the `ts` of the
+        thread's parent message and replies is the array of its reply message dicts.
+    """
+    if not threads:
+        return
+    job['threads_bytes'] = __append_lines(job, "threads.jsonl", job['threads_bytes'], [{'ts': timestamp, 'replies': replies} for timestamp, replies in threads])
+    job['threads_done'] += len(threads)
+    save(job)
+
+
+def load_threads(job):
+    """
+    Returns a dict of parent message `ts` to the array of its replies, for every
+    checkpointed thread expansion.
+
+    job: a job dict as made by new_job.
+    """
+    return {thread['ts']: thread['replies'] for thread in __read_lines(job, "threads.jsonl", job['threads_done'])}
+
+
+def __job_dir(job):
+    """
+    Returns the directory a job's checkpoint lives in.
+    Private function.
+    """
+    return os.path.join(CHECKPOINT_DIR, job['job_id'])
+
+
+def __append_lines(job, name, offset, objs):
+    """
+    Write each of objs as a new line of a job's .jsonl file at byte offset, dropping anything
+    after it that was left over from a crash. Returns the new end offset.
+    Private function.
+    """
+    path = os.path.join(__job_dir(job), name)
+    with open(path, "ab") as file:
+        file.truncate(offset)
+        file.write(b"".join(json.dumps(obj).encode() + b"\n" for obj in objs))
+        file.flush()
+        os.fsync(file.fileno())
+        return file.tell()
+
+
+def __read_lines(job, name, line_count):
+    """
+    Returns the first line_count decoded lines of a job's .jsonl file.
+    Private function.
+    """
+    path = os.path.join(__job_dir(job), name)
+    if not line_count:
+        return []
+    with open(path) as file:
+        return [json.loads(file.readline()) for _ in range(line_count)]
@@ -0,0 +1,138 @@
+"""
+carmille.estimate: Sizes up an archive request before we commit to it.
+
+estimate_archive samples conversations.history across the requested window and extrapolates how
+many messages, threads and bytes the whole archive will come to; admission turns that into a
+decision about whether (and how urgently) to run it.
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+# How many evenly spaced slices of the window to sample, when one page doesn't cover it.
+SAMPLE_SLICES = 8
+
+# Messages per sample request. (Also the page size fetch uses, so one page is one API call either way.)
+SAMPLE_LIMIT = 200
+
+# Admission decisions.
+ADMIT = "admit"
+LOW_PRIORITY = "low_priority"
+TOO_BIG = "too_big"
+
+
+async def estimate_archive(client, channel_id, start_time, end_time):
+    """
+    Predict how big an archive of a channel will be, without fetching all of it.
+    Returns a dict:
+    {'messages': int, 'threads': int, 'replies': int, 'bytes': int, 'exact': bool}
+    'bytes' is the rough uncompressed size of the JSON and HTML files together. 'exact' is True
+    if the whole window fit in one page, so the counts aren't extrapolated.
+
+    client: the client from the context object.
+    channel_id: the human-opaque Slack channel identifier.
+    start_time: the `time.struct_time` representing the beginning of the messages.
+    end_time: the `time.struct_time` representing the end of the messages.
+    """
+    oldest = time.mktime(start_time)
+    latest = time.mktime(end_time)
+
+    # Most requests are small enough that one page holds the whole window. Then we know exactly.
+    res = await client.conversations_history(channel=channel_id, oldest=oldest, latest=latest, inclusive=True, limit=SAMPLE_LIMIT)
+    if not res['has_more']:
+        return __tally([(res['messages'], 1.0)], True)
+
+    # Otherwise, sample evenly spaced slices, all at once so the requester isn't kept waiting on
+    # them one by one. A slice that doesn't fit in one page gets scaled up by how much of the
+    # slice its page actually covered.
+    slice_length = (latest - oldest) / SAMPLE_SLICES
+    samples = list(await asyncio.gather(*[
+        __sample(client, channel_id, oldest + index * slice_length, oldest + (index + 1) * slice_length)
+        for index in range(SAMPLE_SLICES - 1)]))
+
+    # The page we already have is the newest slice's sample (or more than it), so that one
+    # doesn't need asking for again.
+    newest_oldest = oldest + (SAMPLE_SLICES - 1) * slice_length
+    in_newest = [message for message in res['messages'] if float(message['ts']) >= newest_oldest]
+    samples.append(__scaled(in_newest, len(in_newest) == len(res['messages']), latest, slice_length))
+
+    return __tally(samples, False)
+
+
+def admission(estimate, low_priority_over, too_big_over):
+    """
+    Decide what to do with an archive request, given its estimate.
+    Returns ADMIT, LOW_PRIORITY, or TOO_BIG.
+
+    estimate: a dict as returned by estimate_archive.
+    low_priority_over: archives of more messages (including replies) than this go to the low-priority lane.
+    too_big_over: archives of more messages (including replies) than this are turned away.
+    """
+    total = estimate['messages'] + estimate['replies']
+    if total > too_big_over:
+        return TOO_BIG
+    if total > low_priority_over:
+        return LOW_PRIORITY
+    return ADMIT
+
+
+def describe(estimate):
+    """
+    Returns a short human-readable summary of an estimate, for telling users about it.
+    """
+    approximately = "" if estimate['exact'] else "about "
+    megabytes = estimate['bytes'] / 1000000
+    return f"{approximately}{estimate['messages']:,} messages and {estimate['threads']:,} threads with {estimate['replies']:,} replies, {approximately}{megabytes:,.1f} MB before compression"
+
+
+async def __sample(client, channel_id, slice_oldest, slice_latest):
+    """
+    Fetch one page of a slice of the window. Returns a (messages, scale) sample.
+    Private function.
+    """
+    res = await client.conversations_history(channel=channel_id, oldest=slice_oldest, latest=slice_latest, inclusive=True, limit=SAMPLE_LIMIT)
+    return __scaled(res['messages'], res['has_more'], slice_latest, slice_latest - slice_oldest)
+
+
+def __scaled(messages, has_more, slice_latest, slice_length):
+    """
+    Returns a (messages, scale) sample for one page of a slice.
+    Private function.
+    """
+    scale = 1.0
+    if has_more and messages:
+        # Pages come newest first, so the page covers from its oldest message to the slice's end.
+        covered = slice_latest - min(float(message['ts']) for message in messages)
+        scale = slice_length / max(covered, 1.0)
+    return (messages, scale)
+
+
+def __tally(samples, exact):
+    """
+    Add up (messages, scale) samples into an estimate dict.
+    Private function.
+    """
+    messages = threads = replies = size = 0.0
+    sampled = sampled_size = 0
+    for sample_messages, scale in samples:
+        messages += len(sample_messages) * scale
+        for message in sample_messages:
+            if message.get('reply_count', 0):
+                threads += scale
+                replies += message['reply_count'] * scale
+            sampled += 1
+            sampled_size += len(json.dumps(message))
+    if sampled:
+        # The JSON and the HTML each come out to roughly the size of the raw message.
+        size = 2 * (sampled_size / sampled) * (messages + replies)
+    estimate = {
+        'messages': round(messages),
+        'threads': round(threads),
+        'replies': round(replies),
+        'bytes': round(size),
+        'exact': exact,
+    }
+    logging.debug(f"Archive estimate: {estimate}")
+    return estimate
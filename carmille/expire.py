@@ -0,0 +1,107 @@
+"""
+carmille.expire: Deletes old archives from the S3 bucket.
+
+Runs either inside the service (see EXPIRE_ARCHIVES_AFTER in main.py) or from the command line:
+
+    python3 -m carmille.expire --max-age 3600
+
+New archives live under an upload-hour prefix (see carmille.export.UPLOAD_SHARD_FORMAT). An hour
+prefix that ended before the cutoff is deleted wholesale, one that started after it is skipped
+without being listed, and only the hour straddling the cutoff (plus any old unsharded objects)
+needs each object's LastModified checked.
+"""
+
+import argparse
+import calendar
+import logging
+import os
+import time
+
+from . import export
+
+# The most keys a single DeleteObjects request may carry.
+DELETE_BATCH_SIZE = 1000
+
+
+def remove_old_archives(max_age=3600, dry_run=False):
+    """
+    Delete every archive in the bucket older than max_age seconds.
+    Returns a dict: {'deleted': int, 'retained': int, 'skipped_shards': int, 'seconds': float}.
+    'retained' only counts objects that were actually listed; 'skipped_shards' counts upload-hour
+    prefixes that were too new to need listing at all.
+
+    max_age: how old, in seconds, an archive has to be before it's deleted.
+    dry_run: if True, report what would be deleted, but don't delete it.
+
+    Note: relies on the same S3_* environment variables as carmille.export.upload_archive.
+    """
+    began = time.monotonic()
+    S3_BUCKET = os.environ.get('S3_BUCKET')
+    s3_client = export.get_s3_client()
+    cutoff = time.time() - max_age
+
+    results = {'deleted': 0, 'retained': 0, 'skipped_shards': 0}
+    pending = []
+
+    def flush():
+        if pending and not dry_run:
+            res = s3_client.delete_objects(Bucket=S3_BUCKET, Delete={'Objects': [{'Key': key} for key in pending], 'Quiet': True})
+            for error in res.get('Errors', []):
+                logging.error(f"Couldn't delete {error.get('Key')}: {error.get('Code')} {error.get('Message')}")
+                results['deleted'] -= 1
+        results['deleted'] += len(pending)
+        pending.clear()
+
+    def queue(key):
+        pending.append(key)
+        if len(pending) >= DELETE_BATCH_SIZE:
+            flush()
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Delimiter='/'):
+        # Unsharded objects at the top of the bucket: check each one.
+        for obj in page.get('Contents', []):
+            if obj['LastModified'].timestamp() < cutoff:
+                queue(obj['Key'])
+            else:
+                results['retained'] += 1
+
+        for common_prefix in page.get('CommonPrefixes', []):
+            prefix = common_prefix['Prefix']
+            shard_start = __shard_start(prefix)
+            if shard_start is not None and shard_start >= cutoff:
+                results['skipped_shards'] += 1
+                continue
+            whole_shard_expired = shard_start is not None and shard_start + 3600 <= cutoff
+            for shard_page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix):
+                for obj in shard_page.get('Contents', []):
+                    if whole_shard_expired or obj['LastModified'].timestamp() < cutoff:
+                        queue(obj['Key'])
+                    else:
+                        results['retained'] += 1
+    flush()
+
+    results['seconds'] = time.monotonic() - began
+    logging.info(f"Archive expiry {'(dry run) ' if dry_run else ''}deleted {results['deleted']}, retained {results['retained']}, skipped {results['skipped_shards']} recent shards in {results['seconds']:.1f}s.")
+    return results
+
+
+def __shard_start(prefix):
+    """
+    Returns the Unix time at which an upload-hour prefix like "2021-02-03-04/" began,
+    or None if it isn't one.
+    Private function.
+    """
+    try:
+        return calendar.timegm(time.strptime(prefix.rstrip('/'), export.UPLOAD_SHARD_FORMAT))
+    except ValueError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Delete old Carmille archives from the S3 bucket.")
+    parser.add_argument('--max-age', type=int, default=3600, help="Delete archives older than this many seconds. (Default: 3600)")
+    parser.add_argument('--dry-run', action='store_true', help="Report what would be deleted without deleting it.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    remove_old_archives(args.max_age, args.dry_run)
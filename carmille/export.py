@@ -2,6 +2,8 @@
 carmille.export: Takes an array of Slack message dicts and exports them as a file.
 """
 
+import asyncio
+import functools
 import json
 import logging
 import datetime
@@ -11,12 +13,31 @@ import os
 import string
 import shutil
 import random
-import markdown
-import boto3
-from botocore.exceptions import ClientError
-from dateutil import tz
+import threading
 
-utctzobject = tz.tzutc()
+# markdown and boto3 are slow to import, so they're imported where they're used instead of
+# here; prewarm() pulls them in ahead of time once the server is up.
+
+from . import checkpoint
+from . import profiling
+from . import msgindex
+
+# Archives are uploaded under a prefix naming the UTC hour they were uploaded in, so that
+# carmille.expire can throw away whole hours at a time without looking at each object.
+UPLOAD_SHARD_FORMAT = "%Y-%m-%d-%H"
+
+# What make_archive returns instead of a URL when it can't upload the archive.
+ARCHIVE_FAILED_MESSAGE = "Unfortunately, the archive failed. Look at the logs. Sorry!"
+
+# How many messages make_html writes between checkpoints, when it's given a job.
+HTML_CHECKPOINT_INTERVAL = 500
+
+utctzobject = datetime.timezone.utc
+
+# Built by get_s3_client on first use. It's called from executor threads, sometimes several at
+# once (prewarm, archive expiry and the first upload, say), so building it takes the lock.
+__s3_client = None
+__s3_client_lock = threading.Lock()
 
 HTML_HEADER_STRING="""
 <!DOCTYPE html>
@@ -119,10 +140,62 @@ HTML_FOOTER_STRING="""
 </html>
 """
 
-async def upload_archive(directory, filename):
+def get_s3_client():
+    """
+    Return a boto3 S3 client for the configured S3 endpoint.
+    It's built on first use, then reused, so its connection pool stays warm.
+
+    Note: relies on the following environment variables:
+    S3_API_ENDPOINT -- e.g., us-east-1.linodeobjects.com
+    S3_ACCESS_KEY -- your S3 access key
+    S3_SECRET_KEY -- your S3 secret key
+    """
+    global __s3_client
+    with __s3_client_lock:
+        if __s3_client is None:
+            import boto3
+
+            S3_API_ENDPOINT = os.environ.get('S3_API_ENDPOINT')
+            S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY')
+            S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY')
+
+
+            cfg = {
+                "aws_access_key_id": S3_ACCESS_KEY,
+                "aws_secret_access_key": S3_SECRET_KEY,
+                # A bare hostname means HTTPS; a full URL (like a local fake for load testing) is used as is.
+                "endpoint_url": S3_API_ENDPOINT if "://" in S3_API_ENDPOINT else f"https://{S3_API_ENDPOINT}",
+            }
+
+            # A session of our own, rather than boto3's shared default one, which isn't
+            # safe to make clients from in more than one thread at a time.
+            __s3_client = boto3.session.Session().client('s3', **cfg)
+        return __s3_client
+
+
+def prewarm():
+    """
+    Import the slow-to-import libraries export needs, build the S3 client, and open a
+    connection to the bucket, so the first archive doesn't have to wait for any of it.
+    Blocking; meant to be run in an executor.
+
+    Note: relies on the same environment variables as upload_archive.
+    """
+    import markdown
+    from botocore.exceptions import ClientError
+    S3_BUCKET = os.environ.get('S3_BUCKET')
+    try:
+        get_s3_client().head_bucket(Bucket=S3_BUCKET)
+    except ClientError as errormessage:
+        # We still got a connection out of it, which is what we were after.
+        logging.warning(errormessage)
+
+
+async def upload_archive(directory, filename, key=None):
     """
     Push a file to a configured S3 bucket.
     filename: the local filename (and local path) to the file in question.
+    key: the object name to store it under. Defaults to filename.
 
     Note: relies on the following environment variables:
     S3_API_ENDPOINT -- e.g., us-east-1.linodeobjects.com
@@ -130,38 +203,35 @@ async def upload_archive(directory, filename):
     S3_ACCESS_KEY -- your S3 access key
     S3_SECRET_KEY -- your S3 secret key
     """
-    S3_API_ENDPOINT = os.environ.get('S3_API_ENDPOINT')
+    from botocore.exceptions import ClientError
     S3_BUCKET = os.environ.get('S3_BUCKET')
-    S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY')
-    S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY')
-
-
-    cfg = {
-        "aws_access_key_id": S3_ACCESS_KEY,
-        "aws_secret_access_key": S3_SECRET_KEY,
-        "endpoint_url": f"https://{S3_API_ENDPOINT}",
-    }
 
-    s3_client = boto3.client('s3', **cfg)
+    s3_client = get_s3_client()
     try:
-        s3_client.upload_file(f"{directory}/{filename}", S3_BUCKET, filename, ExtraArgs={'ACL': 'public-read'})
+        # boto3 is synchronous, so keep it off the event loop; other jobs' requests carry on meanwhile.
+        await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+            s3_client.upload_file, f"{directory}/{filename}", S3_BUCKET, key or filename, ExtraArgs={'ACL': 'public-read'}))
     except ClientError as errormessage:
         logging.error(errormessage)
         return False
     return True
 
 
-async def make_archive(channel_name, start_time, end_time, messages, users_dict, tz_offset):
+async def make_archive(channel_name, start_time, end_time, index, users_dict, tz_offset, job=None, profile=None, first=0, last=None):
     """
     Construct a zip file of Slack messages containing a JSON and an HTML representation.
 
     channel_name: the human-readable Slack channel name. Used for file naming.
     start_time: the `time.struct_time` representing the beginning of the messages.
     end_time: the `time.struct_time` representing the end of the messages.
-    messages: the array of message dicts as formatted by carmille.fetch.
+    index: the carmille.msgindex.MessageIndex of the messages, with every message stitched.
     users_dict: a nested dict object in the format
         userid: {'display_name': display_name, 'icon_url': icon_url} .
     tz_offset: the requesting user's local time offset from UTC, in integer seconds.
+    job: optional job dict from carmille.checkpoint. If given, export progress is checkpointed,
+        and a job that was already partway through exporting picks up where it left off.
+    profile: optional profile dict from carmille.profiling. If given, each stage is recorded in it.
+    first, last: optionally, archive only the index's messages in positions [first, last).
 
     Note: relies on the following environment variables:
     S3_WEBSITE_PREFIX -- the entire string to put before the object name to get a place to download the file. e.g., https://carmille.supercoolhost.net
@@ -170,11 +240,24 @@ async def make_archive(channel_name, start_time, end_time, messages, users_dict,
     logging.debug("Entering the archive process.")
     S3_WEBSITE_PREFIX = os.environ.get('S3_WEBSITE_PREFIX')
 
-    letters = string.ascii_lowercase
-    randstr = ''.join(random.choice(letters) for i in range(5))
-    os.mkdir(f"tmp/{randstr}")
+    if job and job['archive_url']:
+        # We already uploaded it before a restart; we just never got to say so.
+        return job['archive_url']
+
+    if last is None:
+        last = len(index.messages)
+
+    if job and job['export_dir']:
+        randstr = job['export_dir']
+    else:
+        letters = string.ascii_lowercase
+        randstr = ''.join(random.choice(letters) for i in range(5))
+        os.mkdir(f"tmp/{randstr}")
+        if job:
+            job['export_dir'] = randstr
+            checkpoint.save(job)
 
-    user_tz = tz.tzoffset(None, tz_offset)
+    user_tz = datetime.timezone(datetime.timedelta(seconds=tz_offset))
 
     start_datetime = datetime.datetime.fromtimestamp(time.mktime(start_time)).astimezone(user_tz)
     end_datetime = datetime.datetime.fromtimestamp(time.mktime(end_time)).astimezone(user_tz)
@@ -183,25 +266,75 @@ async def make_archive(channel_name, start_time, end_time, messages, users_dict,
     filepart = f"{channel_name}_{start_datetime.strftime('%Y-%m-%d-%H-%M')}_to_{end_datetime.strftime('%Y-%m-%d-%H-%M')}"
 
     filename = f"tmp/{randstr}/{filepart}"
-    zipfilename = f"tmp/{filepart}"
-
-    await make_json(filename, messages, users_dict)
-    # Only make_html needs user_tz, because it's the one that tries to do "human_readable" stuff.
-    await make_html(filename, messages, users_dict, user_tz)
-
-    shutil.make_archive(zipfilename, "zip", f"tmp/{randstr}")
-    shutil.rmtree(f"tmp/{randstr}")
+    # Prefixed with randstr so that simultaneous archives of the same window don't collide.
+    zipfilename = f"tmp/{randstr}_{filepart}"
+
+    if job:
+        # Anything the checkpoint says is done but isn't on disk anymore (say, tmp got cleaned out
+        # from under us) has to be done again, rather than zipping and uploading an empty archive.
+        __forget_missing_files(job, filename, zipfilename)
+        if not job['zip_done']:
+            os.makedirs(f"tmp/{randstr}", exist_ok=True)
+
+    if not (job and job['zip_done']):
+        if not (job and job['json_done']):
+            with profiling.stage(profile, 'json'):
+                await make_json(filename, index.messages[first:last], users_dict)
+            if job:
+                job['json_done'] = True
+                checkpoint.save(job)
+        # Only make_html needs user_tz, because it's the one that tries to do "human_readable" stuff.
+        with profiling.stage(profile, 'html'):
+            await make_html(filename, index, first, last, users_dict, user_tz, job)
+
+        with profiling.stage(profile, 'zip'):
+            shutil.make_archive(zipfilename, "zip", f"tmp/{randstr}")
+        # Only throw the files away once the checkpoint says the zip has them, so a crash in
+        # between can't leave us with neither.
+        if job:
+            job['zip_done'] = True
+            checkpoint.save(job)
+        shutil.rmtree(f"tmp/{randstr}")
     logging.debug("Finished the archive process.")
 
-    upload_result = await upload_archive("tmp", f"{filepart}.zip")
+    key = f"{time.strftime(UPLOAD_SHARD_FORMAT, time.gmtime())}/{filepart}.zip"
+    with profiling.stage(profile, 'upload'):
+        upload_result = await upload_archive("tmp", f"{randstr}_{filepart}.zip", key)
     if upload_result:
         logging.debug("Finished upload process.")
-        os.remove(f"tmp/{filepart}.zip")
-        return f"{S3_WEBSITE_PREFIX}/{filepart}.zip"
+        os.remove(f"{zipfilename}.zip")
+        if job:
+            job['archive_url'] = f"{S3_WEBSITE_PREFIX}/{key}"
+            checkpoint.save(job)
+        return f"{S3_WEBSITE_PREFIX}/{key}"
     else:
-        return "Unfortunately, the archive failed. Look at the logs. Sorry!"
+        return ARCHIVE_FAILED_MESSAGE
 
 
+def __forget_missing_files(job, filename, zipfilename):
+    """
+    Reset a checkpointed job's export progress for any output file that has gone missing.
+    Private function.
+
+    job: a job dict from carmille.checkpoint.
+    filename: the JSON and HTML files' path, without extension.
+    zipfilename: the zip file's path, without extension.
+    """
+    if job['zip_done'] and not os.path.exists(f"{zipfilename}.zip"):
+        logging.warning(f"Job {job['job_id']}'s zip file is missing; making it again.")
+        job['zip_done'] = False
+    if job['zip_done']:
+        return
+    if job['json_done'] and not os.path.exists(f"{filename}.json"):
+        logging.warning(f"Job {job['job_id']}'s JSON file is missing; making it again.")
+        job['json_done'] = False
+    if (job['html_done'] or job['html_offset']) and not os.path.exists(f"{filename}.html"):
+        logging.warning(f"Job {job['job_id']}'s HTML file is missing; making it again.")
+        job['html_done'] = False
+        job['html_messages'] = 0
+        job['html_offset'] = 0
+    checkpoint.save(job)
+
 async def make_json(filename, messages, users_dict):
     """
     Construct a JSON archive of Slack messages.
@@ -221,34 +354,66 @@ async def make_json(filename, messages, users_dict):
     logging.debug("I have finished the JSON dump process.")
     return filename
 
-async def make_html(filename, messages, users_dict, user_tz):
+async def make_html(filename, index, first, last, users_dict, user_tz, job=None):
     """
     Construct an HTML archive of Slack messages.
+    Message times come from the index's parsed keys, rather than each message's `ts` string.
 
     channel_name: the human-readable Slack channel name. Used for file naming.
     start_time: the `time.struct_time` representing the beginning of the messages.
     end_time: the `time.struct_time` representing the end of the messages.
-    messages: the array of message dicts as formatted by carmille.fetch.
+    index: the carmille.msgindex.MessageIndex of the messages, with every message stitched.
+    first, last: the index positions of the messages to write, [first, last).
     users_dict: a nested dict object in the format
         userid: {'display_name': display_name, 'icon_url': icon_url}
     user_tz: a tzinfo object with the requesting user's timezone set.
+    job: optional job dict from carmille.checkpoint. If given, the file is checkpointed every
+        HTML_CHECKPOINT_INTERVAL messages, and a partially written file is resumed.
     """
 
     logging.debug("I have begun the HTML dump process.")
     filename = f"{filename}.html"
-    with open(filename, "w") as file:
+
+    if job and job['html_done']:
+        logging.debug("The HTML dump was already finished before a restart.")
+        return
+
+    if job and job['html_offset']:
+        # Throw away anything written after the last checkpoint, and carry on from there.
+        first_message = job['html_messages']
+        file = open(filename, "r+")
+        file.seek(job['html_offset'])
+        file.truncate()
+    else:
+        first_message = 0
+        file = open(filename, "w")
         file.write(HTML_HEADER_STRING)
-        for message in messages:
-            file.write(__render_one_message(message, users_dict, user_tz))
+
+    with file:
+        for written in range(first_message, last - first):
+            position = first + written
+            file.write(__render_one_message(index.messages[position], index.keys[position], index.reply_keys_of(position), users_dict, user_tz))
+            if job and (written + 1) % HTML_CHECKPOINT_INTERVAL == 0:
+                file.flush()
+                os.fsync(file.fileno())
+                job['html_messages'] = written + 1
+                job['html_offset'] = file.tell()
+                checkpoint.save(job)
         file.write(HTML_FOOTER_STRING)
+
+    if job:
+        job['html_done'] = True
+        checkpoint.save(job)
     logging.debug("I have finished the HTML dump process.")
     return filename
 
-def __render_one_message(message, users_dict, user_tz):
+def __render_one_message(message, key, reply_keys, users_dict, user_tz):
     """
     Renders one message to HTML and returns the string.
     Private method.
 
+    key: the message's `ts`, as parsed by carmille.msgindex.
+    reply_keys: the same for each of its replies, in order.
     users_dict: a nested dict object in the format
         userid: {'display_name': display_name, 'icon_url': icon_url}
     user_tz: a tzinfo object with the requesting user's timezone set.
@@ -269,13 +434,13 @@ def __render_one_message(message, users_dict, user_tz):
     ret += f"<span class='username'>@{users_dict[message['user']]['display_name']}</span>"
 
     # Timezone math
-    # This line takes an epoch timestamp that's passed as a string float.
-    # It converts it to a float, then to an integer, to drop the sub-second bit.
+    # This line takes the epoch timestamp the index already parsed to integer microseconds
+    # (see carmille.msgindex), and turns it into whole seconds.
     # It then parses it into a UTC datetime object.
     # Finally, it excretes it into the user's timezone.
     # utctzobject is made once, at the top of this file, to avoid having to
     # construct it on every single message.
-    message_time = datetime.datetime.fromtimestamp(int(float(message['ts'])),utctzobject).astimezone(user_tz)
+    message_time = datetime.datetime.fromtimestamp(key // 1000000,utctzobject).astimezone(user_tz)
 
     ret += f"<span class='timestamp'>{message_time.strftime('%Y-%m-%d %H:%M %z')}</span>"
 
@@ -287,14 +452,14 @@ def __render_one_message(message, users_dict, user_tz):
         for block in message['blocks']:
             ret += __render_one_block(block)
     else:
-        mod_text = re.sub(r'<@([UW][A-Z0-9]+)>',
+        mod_text = msgindex.USER_MENTION.sub(
             lambda x: "<span class='username'>@"+users_dict[x.group(1)]['display_name']+"</span>",
             message['text'])
         ret += f"{mod_text}\n"
 
     # Optional components
-    for thread_message in message.get('replies', []):
-        ret += __render_one_message(thread_message, users_dict, user_tz)
+    for thread_message, reply_key in zip(message.get('replies', []), reply_keys):
+        ret += __render_one_message(thread_message, reply_key, (), users_dict, user_tz)
     for attachment in message.get('attachments', []):
         ret += __render_one_attachment(attachment)
     if message.get('reactions', None):
@@ -371,6 +536,7 @@ def __render_one_attachment(attachment):
     mrkdown = attachment['text']
     mrkdown = re.sub(r"<([^|]+)\|([^>]+)>", r"[\2](\1)", mrkdown)
 
+    import markdown
     ret += markdown.markdown(mrkdown)
 
     if attachment.get('image_url', None):
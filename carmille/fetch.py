@@ -2,13 +2,21 @@
 carmille.fetch: Interacts with the Slack API and grabs message archives.
 """
 
+import bisect
 import time
+import datetime
 import logging
 import re
 
 from . import export # Go get the export.py file so we can use it
+from . import checkpoint
+from . import profiling
+from . import msgindex
 
-async def get_message_archive(client, channel_id, channel_name, start_time, end_time, tz_offset):
+# How many thread expansions to checkpoint at a time.
+THREAD_CHECKPOINT_INTERVAL = 100
+
+async def get_message_archive(client, channel_id, channel_name, start_time, end_time, tz_offset, job=None, profile=None, on_slice=None):
     """
     Fetch, construct, and return a JSON archive of Slack messages.
 
@@ -18,6 +26,16 @@ async def get_message_archive(client, channel_id, channel_name, start_time, end_
     start_time: the `time.struct_time` representing the beginning of the messages.
     end_time: the `time.struct_time` representing the end of the messages.
     tz_offset: the requesting user's local time offset from UTC, in integer seconds.
+    job: optional job dict from carmille.checkpoint. If given, progress is checkpointed to
+        disk as we go, and anything already checkpointed is reused instead of refetched.
+    profile: optional profile dict from carmille.profiling. If given, each stage and every Slack
+        API call is recorded in it.
+    on_slice: optional async function(publish). If given, and the window covers more than one
+        day (in the requesting user's time zone), it's called each time another day has all its
+        threads in. It may await publish(), which archives and uploads every finished day not
+        already published as one slice, and returns (label, url), or None if that failed. It
+        returns False once it will never publish again, and then isn't called any more.
+        The full archive still comes at the end.
     """
     # https://api.slack.com/methods/conversations.history
 
@@ -29,85 +47,205 @@ async def get_message_archive(client, channel_id, channel_name, start_time, end_
     # Recommended limit value is 200.
     # Set to 5 to ensure pagination works correctly, but that'll make the Slack API hate you.
 
-    res = await client.conversations_history(channel=channel_id, oldest=time.mktime(start_time), latest=time.mktime(end_time), inclusive=True, limit=200)
-
-    messages_group = res['messages']
-
-    has_more = res['has_more']
+    oldest = time.mktime(start_time)
+    latest = time.mktime(end_time)
 
-    all_users = []
     all_emoji = []
 
     users_dict = {}
 
-    if res.get('response_metadata', None) and res['response_metadata'].get('next_cursor', None):
-        new_cursor = res['response_metadata']['next_cursor']
-    while has_more:
-        res = await client.conversations_history(channel=channel_id, oldest=time.mktime(start_time), latest=time.mktime(end_time), inclusive=True, limit=200, cursor=new_cursor)
+    # If we were handed a checkpointed job, pick up wherever it left off: every page it already
+    # fetched is on disk, along with the cursor for the next one.
+    # If we were handed a profile, time this stage and every API call in it.
+    client = profiling.timed_client(client, profile)
+    with profiling.stage(profile, 'history'):
+        if job:
+            messages_group = checkpoint.load_history(job)
+            new_cursor = job['history_cursor']
+            has_more = not job['history_done']
+        else:
+            messages_group = []
+            new_cursor = None
+            has_more = True
+
+        while has_more:
+            if new_cursor:
+                res = await client.conversations_history(channel=channel_id, oldest=oldest, latest=latest, inclusive=True, limit=200, cursor=new_cursor)
+            else:
+                res = await client.conversations_history(channel=channel_id, oldest=oldest, latest=latest, inclusive=True, limit=200)
+
+            messages_group.extend(res['messages'])
+
+            has_more = res['has_more']
 
-        messages_group.extend(res['messages'])
+            if res.get('response_metadata', None) and res['response_metadata'].get('next_cursor', None):
+                new_cursor = res['response_metadata']['next_cursor']
 
-        has_more = res['has_more']
+            if job:
+                checkpoint.record_history_page(job, res['messages'], new_cursor, not has_more)
 
-        if res.get('response_metadata', None) and res['response_metadata'].get('next_cursor', None):
-            new_cursor = res['response_metadata']['next_cursor']
-    messages_group.sort(key=__message_timestamp_sort)
+        # The index parses every timestamp once and keeps the messages in time order; from here
+        # on, it's also where replies get stitched on and users get collected.
+        index = msgindex.MessageIndex(messages_group)
+        messages_group = index.messages
 
     # OK! Now we've retrieved all the main-channel messages. Now there are things the Slack API
     # forces us to retrieve on an inefficient, per-message basis.
 
-    for message in messages_group:
+    with profiling.stage(profile, 'threads'):
+        completed_threads = checkpoint.load_threads(job) if job else {}
+        # Thread expansions waiting to be checkpointed; they go to disk in batches, because
+        # syncing after every one holds up everything else this process is doing.
+        unsaved_threads = []
+
+        slice_day = None
+        # Messages before this position have already gone out in a slice (before a restart, maybe).
+        unpublished_first = bisect.bisect_left(index.keys, job['published_until'] * 1000000) if job else 0
+
+        async def publish():
+            # Everything before the message we're up to is finished, replies and all.
+            nonlocal unpublished_first
+            published = await __publish_slice(client, channel_name, index, unpublished_first, position, users_dict, tz_offset, oldest, latest, job)
+            if published:
+                unpublished_first = position
+            return published
+
+        try:
+            for position, message in enumerate(messages_group):
+
+                # Messages are in time order, so once we see one from a new day, every message
+                # from the previous days (and their replies) is done, and those days can go out early.
+                if on_slice:
+                    day = index.day_number(position, tz_offset)
+                    if position > unpublished_first and day != slice_day:
+                        if not await on_slice(publish):
+                            on_slice = None
+                    slice_day = day
+
+                #all_emoji.extend(get_emoji_in_message(message)) # See TODO in __fetch_emoji_urls
+
+                # This block looks for and, if necessary, fetches thread replies to a message, adding them to the JSON.
+                # https://api.slack.com/methods/conversations.replies
+                tmessages_group = []
+                if 'thread_ts' in message:
+                    # This means it's part of a thread. We have to do the whole same song and dance now.
+                    timestamp = message['ts'] # Unique identifier used to identify any message. We only care for start of thread.
+                    if timestamp in completed_threads:
+                        # We already expanded this one before a restart.
+                        tmessages_group = completed_threads[timestamp]
+                    else:
+                        tmessages_group = await __fetch_thread_replies(client, channel_id, timestamp, oldest, latest)
+                        if job:
+                            unsaved_threads.append((timestamp, tmessages_group))
+                            if len(unsaved_threads) >= THREAD_CHECKPOINT_INTERVAL:
+                                checkpoint.record_threads(job, unsaved_threads)
+                                unsaved_threads = []
+
+                    #for tmessage in tmessages_group:
+                    #    all_emoji.extend(get_emoji_in_message(tmessage)) # See TODO in __fetch_emoji_urls
+
+                # Finally, drop the replies into the message object above, and add everyone in the
+                # message and its replies to the index's user table.
+                index.stitch(position, tmessages_group)
+
+                # Another block would look for and fetch emoji reactions (reactji) to a message.
+                # https://api.slack.com/methods/reactions.get
+                # ...actually at the moment it looks like these are being retrieved as part of the normal work.
+                # For now we'll leave this comment here, but not do anything.
+        except Exception:
+            # Whatever's expanded so far is worth keeping, even if a Slack call just failed and
+            # this attempt is about to be retried. (But not if we were cancelled: then the job
+            # belongs to another worker now, and so does its checkpoint.)
+            if job:
+                checkpoint.record_threads(job, unsaved_threads)
+            raise
+        if job:
+            checkpoint.record_threads(job, unsaved_threads)
 
-        all_users.extend(get_users_in_message(message))
-        #all_emoji.extend(get_emoji_in_message(message)) # See TODO in __fetch_emoji_urls
 
-        # This block looks for and, if necessary, fetches thread replies to a message, adding them to the JSON.
-        # https://api.slack.com/methods/conversations.replies
-        if 'thread_ts' in message:
-            # This means it's part of a thread. We have to do the whole same song and dance now.
-            timestamp = message['ts'] # Unique identifier used to identify any message. We only care for start of thread.
-            res = await client.conversations_replies(channel=channel_id, ts=timestamp, oldest=time.mktime(start_time), latest=time.mktime(end_time), inclusive=True, limit=200)
+        # Go fetch the users and turn them into a dict.
+        # (Once, now that we've seen every message, rather than once per message. Any we
+        # already fetched for an early slice don't need fetching again.)
+        users_dict.update(await __fetch_user_names_and_icons(client, set(index.user_ids) - users_dict.keys()))
 
-            # Deleting the very first one because it'll be a duplicate of the thread topper.
-            tmessages_group = res['messages'][1:]
+    logging.debug(f"done! I retrieved {len(messages_group)} messages, including any thread replies to them.")
 
-            thas_more = res['has_more']
+    return await export.make_archive(channel_name, start_time, end_time, index, users_dict, tz_offset, job, profile)
 
-            if res.get('response_metadata', None) and res['response_metadata'].get('next_cursor', None):
-                tnew_cursor = res['response_metadata']['next_cursor']
+async def __fetch_thread_replies(client, channel_id, timestamp, oldest, latest):
+    """
+    Fetch every reply to a thread.
+    Returns an array of message dicts, not including the thread topper.
+    Private function.
 
-            while thas_more:
-                res = await client.conversations_replies(channel=channel_id, ts=timestamp, oldest=time.mktime(start_time), latest=time.mktime(end_time), inclusive=True, limit=200, cursor=tnew_cursor)
+    client: the client from the context object.
+    channel_id: the human-opaque Slack channel identifier.
+    timestamp: the `ts` of the thread topper.
+    oldest, latest: the archive window, in Unix seconds.
+    """
+    res = await client.conversations_replies(channel=channel_id, ts=timestamp, oldest=oldest, latest=latest, inclusive=True, limit=200)
 
-                # Deleting the very first one because it'll be a duplicate of the thread topper.
-                tmessages_group.extend(res['messages'][1:])
+    # Deleting the very first one because it'll be a duplicate of the thread topper.
+    tmessages_group = res['messages'][1:]
 
-                thas_more = res['has_more']
+    thas_more = res['has_more']
 
-                if res.get('response_metadata', None) and res['response_metadata'].get('next_cursor', None):
-                    tnew_cursor = res['response_metadata']['next_cursor']
+    if res.get('response_metadata', None) and res['response_metadata'].get('next_cursor', None):
+        tnew_cursor = res['response_metadata']['next_cursor']
 
-            # Sort them by time, ascending.
-            tmessages_group.sort(key=__message_timestamp_sort)
-            for tmessage in tmessages_group:
-                # Add their users and emoji to the big list.
-                all_users.extend(get_users_in_message(tmessage))
-                #all_emoji.extend(get_emoji_in_message(tmessage)) # See TODO in __fetch_emoji_urls
+    while thas_more:
+        res = await client.conversations_replies(channel=channel_id, ts=timestamp, oldest=oldest, latest=latest, inclusive=True, limit=200, cursor=tnew_cursor)
 
-            # Finally, drop the replies into the message object above.
-            message['replies'] = tmessages_group
+        # Deleting the very first one because it'll be a duplicate of the thread topper.
+        tmessages_group.extend(res['messages'][1:])
 
-        # Another block would look for and fetch emoji reactions (reactji) to a message.
-        # https://api.slack.com/methods/reactions.get
-        # ...actually at the moment it looks like these are being retrieved as part of the normal work.
-        # For now we'll leave this comment here, but not do anything.
+        thas_more = res['has_more']
 
-        # Go fetch the users and turn them into a dict.
-        users_dict = await __fetch_user_names_and_icons(client, all_users)
+        if res.get('response_metadata', None) and res['response_metadata'].get('next_cursor', None):
+            tnew_cursor = res['response_metadata']['next_cursor']
 
-    logging.debug(f"done! I retrieved {len(messages_group)} messages, including any thread replies to them.")
+    # MessageIndex.stitch sorts them by time when they're attached.
+    return tmessages_group
 
-    return await export.make_archive(channel_name, start_time, end_time, messages_group, users_dict, tz_offset)
+async def __publish_slice(client, channel_name, index, first, last, users_dict, tz_offset, oldest, latest, job):
+    """
+    Archive and upload a run of finished days' messages on their own.
+    Returns (label, url), where label names the days covered, or None if the upload failed.
+    Private function.
+
+    client: the client from the context object.
+    channel_name: the human-readable Slack channel name. Used for file naming.
+    index: the carmille.msgindex.MessageIndex of the whole archive.
+    first, last: the messages to archive are index positions [first, last), already stitched.
+        last is the first message of a later day.
+    users_dict: the users fetched so far, in the format from __fetch_user_names_and_icons.
+        Gets any of these messages' users that it's missing added to it.
+    tz_offset: the requesting user's local time offset from UTC, in integer seconds.
+    oldest, latest: the whole archive's window, in Unix seconds.
+    job: optional job dict from carmille.checkpoint. Its published_until is moved up to the
+        end of the slice.
+    """
+    users_dict.update(await __fetch_user_names_and_icons(client, set(index.users_between(first, last)) - users_dict.keys()))
+
+    # From the start of the first message's day to the start of the last one's, trimmed to the
+    # archive's window.
+    slice_start = max(index.day_number(first, tz_offset) * 86400 - tz_offset, oldest)
+    slice_end = min(index.day_number(last, tz_offset) * 86400 - tz_offset, latest)
+
+    url = await export.make_archive(channel_name, time.localtime(slice_start), time.localtime(slice_end), index, users_dict, tz_offset, first=first, last=last)
+    if url == export.ARCHIVE_FAILED_MESSAGE:
+        # The full archive at the end will still have these; no need to give up on the job.
+        return None
+
+    if job:
+        job['published_until'] = slice_end
+        checkpoint.save(job)
+
+    user_tz = datetime.timezone(datetime.timedelta(seconds=tz_offset))
+    first_day = datetime.datetime.fromtimestamp(slice_start, user_tz).date().isoformat()
+    last_day = datetime.datetime.fromtimestamp(slice_end - 1, user_tz).date().isoformat()
+    label = first_day if first_day == last_day else f"{first_day} to {last_day}"
+    return (label, url)
 
 def get_emoji_in_message(message):
     """
@@ -164,7 +302,7 @@ def get_users_in_message(message):
 
     userlist = [message['user']]
 
-    for user in re.findall(r'<@([UW][A-Z0-9]+)>', message['text']):
+    for user in msgindex.USER_MENTION.findall(message['text']):
         userlist.append(user)
 
 
@@ -205,14 +343,3 @@ async def get_tz_offset(client, user_id):
     # https://api.slack.com/methods/users.info
     res = await client.users_info(user=user_id)
     return res['user']['tz_offset']
-
-def __message_timestamp_sort(message):
-    """
-    Returns the Slack message timestamp for a single message.
-    Used to sort Slack message arrays by time.
-    Private function.
-
-    m: A single Slack message dict.
-    """
-
-    return float(message['ts'])
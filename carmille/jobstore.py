@@ -0,0 +1,153 @@
+"""
+carmille.jobstore: A SQLite-backed queue of archive jobs, shared by every worker process on the box.
+
+Whichever worker receives the "Archive!" click enqueues the job; any worker can claim and run it.
+The job's parameters and progress live in its carmille.checkpoint directory; this store only
+tracks who is running what.
+
+A running job is reclaimed by another worker if the process that claimed it has died, or has
+stopped heartbeating for STALE_AFTER seconds. In the second case, the original worker finds out
+at its next heartbeat and stops its copy of the job.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+JOBSTORE_PATH = "data/jobstore.sqlite3"
+
+# How long a running job can go without a heartbeat before another worker takes it over.
+STALE_AFTER = 120
+
+# How many times a job is tried before we give up on it.
+MAX_ATTEMPTS = 3
+
+
+def enqueue(job_id, low_priority=False):
+    """
+    Add a job to the queue. Enqueueing a job that's already there does nothing.
+
+    job_id: the job_id of a job made by carmille.checkpoint.new_job.
+    low_priority: if True, the job waits until no normal jobs are waiting.
+    """
+    with closing(__connect()) as db:
+        db.execute("INSERT OR IGNORE INTO jobs (job_id, state, attempts, created, low_priority) VALUES (?, 'queued', 0, ?, ?)", (job_id, time.time(), int(low_priority)))
+
+
+def claim(running, low_priority_ok=True):
+    """
+    Claim the oldest job that's waiting to be run, or whose worker has gone away. Normal jobs
+    come before low-priority ones.
+    Returns a tuple (job_id, reclaimed, low_priority, gave_up), or None if there's nothing to do.
+    reclaimed is True if someone else had already started on the job.
+    gave_up is True if the job's worker went away on its last allowed attempt (say, because the
+    job itself keeps killing it); then it's taken out of the queue instead of claimed, and the
+    caller should tell the requester and throw its checkpoint away.
+
+    running: the job_ids this process is already running. (A job marked as ours that isn't in
+        here was left behind by an earlier process that happened to have the same pid.)
+    low_priority_ok: if False, only claim normal jobs.
+    """
+    pid = os.getpid()
+    now = time.time()
+    db = __connect()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        rows = db.execute("SELECT job_id, state, worker, heartbeat, attempts, low_priority FROM jobs WHERE state = 'queued' OR state = 'running' ORDER BY low_priority, created").fetchall()
+        for job_id, state, worker, heartbeat, attempts, low_priority in rows:
+            if low_priority and not low_priority_ok:
+                continue
+            if state == 'running' and heartbeat >= now - STALE_AFTER and __process_alive(worker):
+                if worker != pid or job_id in running:
+                    continue
+            if state == 'running' and attempts >= MAX_ATTEMPTS:
+                # fail() never got the chance to give up on it, so we do.
+                db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+                db.execute("COMMIT")
+                logging.error(f"Job {job_id} was abandoned {attempts} times; giving up on it.")
+                return (job_id, True, bool(low_priority), True)
+            db.execute("UPDATE jobs SET state = 'running', worker = ?, heartbeat = ?, attempts = attempts + 1 WHERE job_id = ?", (pid, now, job_id))
+            db.execute("COMMIT")
+            return (job_id, state == 'running', bool(low_priority), False)
+        db.execute("COMMIT")
+        return None
+    finally:
+        db.close()
+
+
+def heartbeat(running):
+    """
+    Mark the jobs this process is running as still alive.
+    Returns the job_ids, out of running, that aren't ours anymore: another worker took them over
+    because we went quiet for too long. Whoever's running those should stop.
+
+    running: the job_ids this process is running.
+    """
+    now = time.time()
+    lost = []
+    with closing(__connect()) as db:
+        for job_id in running:
+            if db.execute("UPDATE jobs SET heartbeat = ? WHERE job_id = ? AND worker = ?", (now, job_id, os.getpid())).rowcount == 0:
+                lost.append(job_id)
+    return lost
+
+
+def complete(job_id):
+    """
+    Take a finished job out of the queue.
+
+    job_id: the job's job_id.
+    """
+    with closing(__connect()) as db:
+        db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+
+def fail(job_id):
+    """
+    Put a job that raised an exception back in the queue, unless it has run out of attempts.
+    Returns True if it will be retried, False if it was dropped.
+
+    job_id: the job's job_id.
+    """
+    with closing(__connect()) as db:
+        row = db.execute("SELECT attempts FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row and row[0] < MAX_ATTEMPTS:
+            db.execute("UPDATE jobs SET state = 'queued', worker = NULL WHERE job_id = ?", (job_id,))
+            return True
+        db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+        logging.error(f"Job {job_id} failed {MAX_ATTEMPTS} times; giving up on it.")
+        return False
+
+
+def __connect():
+    """
+    Open the job store, creating it if need be.
+    Private function.
+    """
+    # Nothing else is guaranteed to have made data/ yet on a fresh install.
+    os.makedirs(os.path.dirname(JOBSTORE_PATH), exist_ok=True)
+    db = sqlite3.connect(JOBSTORE_PATH, timeout=30, isolation_level=None)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, state TEXT NOT NULL, worker INTEGER, heartbeat REAL, attempts INTEGER NOT NULL, created REAL NOT NULL, low_priority INTEGER NOT NULL DEFAULT 0)")
+    try:
+        # Job stores made before there was a low-priority lane.
+        db.execute("ALTER TABLE jobs ADD COLUMN low_priority INTEGER NOT NULL DEFAULT 0")
+    except sqlite3.OperationalError:
+        pass
+    return db
+
+
+def __process_alive(pid):
+    """
+    Returns True if a process with this pid is still running on this box.
+    Private function.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
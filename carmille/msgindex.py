@@ -0,0 +1,127 @@
+"""
+carmille.msgindex: A compact index over an archive's messages.
+
+Each message's `ts` is parsed once, into an integer number of microseconds, and kept in an array
+alongside the messages in time order. As thread replies are stitched onto their parents, the index
+records, in flat arrays with per-message offsets, each reply's parsed `ts` and which users each
+message and its replies mention (as references into a table of unique user IDs). Sorting, slicing
+by day, rendering times, and collecting the users for any run of messages then don't need to
+re-walk or re-parse the dicts.
+"""
+
+import re
+from array import array
+
+USER_MENTION = re.compile(r'<@([UW][A-Z0-9]+)>')
+
+
+def ts_key(ts):
+    """
+    Turn a Slack `ts` string (like "1609459200.000100") into integer microseconds.
+    Exact, unlike going through float().
+    """
+    seconds, _, fraction = ts.partition('.')
+    return int(seconds) * 1000000 + int((fraction + "000000")[:6])
+
+
+def sort_messages(messages):
+    """
+    Sort messages by time, ascending, parsing each `ts` just once.
+    Returns a tuple of (a new list of the sorted messages, an array of their `ts_key`s in the same order).
+
+    messages: an array of message dicts.
+    """
+    keys = [ts_key(message['ts']) for message in messages]
+    order = sorted(range(len(messages)), key=keys.__getitem__)
+    return ([messages[position] for position in order], array('q', [keys[position] for position in order]))
+
+
+class MessageIndex:
+    """
+    An index over top-level messages, in time order. Replies are added with stitch(), one message
+    at a time, in order.
+
+    messages: the top-level messages, in time order.
+    keys: array of each message's `ts`, in integer microseconds.
+    reply_keys: flattened array of every stitched reply's `ts`, in integer microseconds, in the
+        same order as each message's 'replies'.
+    reply_offsets: message i's replies' keys are reply_keys[reply_offsets[i]:reply_offsets[i + 1]].
+    user_ids: every user ID seen so far, each once.
+    user_refs: flattened indexes into user_ids, for each message and its replies.
+    user_ref_offsets: message i's users are user_refs[user_ref_offsets[i]:user_ref_offsets[i + 1]].
+    """
+
+    def __init__(self, messages):
+        """
+        messages: an array of top-level message dicts, in any order.
+        """
+        self.messages, self.keys = sort_messages(messages)
+        self.reply_keys = array('q')
+        self.reply_offsets = array('l', [0])
+        self.user_ids = []
+        self.user_refs = array('l')
+        self.user_ref_offsets = array('l', [0])
+        self.__user_numbers = {}
+
+    def stitch(self, position, replies):
+        """
+        Attach a message's replies, sorted by time, and record its users and theirs.
+        Messages must be stitched in order, starting from 0, including those without replies.
+        Returns the sorted replies.
+
+        position: the message's position in self.messages.
+        replies: the message's reply dicts (an empty list for a message that isn't a thread),
+            in any order.
+        """
+        if position != len(self.reply_offsets) - 1:
+            raise ValueError(f"Messages must be stitched in order; expected {len(self.reply_offsets) - 1}, got {position}.")
+        message = self.messages[position]
+        replies, reply_keys = sort_messages(replies)
+        if 'thread_ts' in message:
+            message['replies'] = replies
+
+        self.reply_keys.extend(reply_keys)
+        self.reply_offsets.append(len(self.reply_keys))
+
+        self.__add_users(message)
+        for reply in replies:
+            self.__add_users(reply)
+        self.user_ref_offsets.append(len(self.user_refs))
+        return replies
+
+    def reply_keys_of(self, position):
+        """
+        Returns the keys of the stitched replies of the message at position, in the same order
+        as its 'replies'.
+        """
+        return self.reply_keys[self.reply_offsets[position]:self.reply_offsets[position + 1]]
+
+    def users_between(self, first, last):
+        """
+        Returns the unique user IDs used by the stitched messages in positions [first, last),
+        and their replies.
+        """
+        refs = self.user_refs[self.user_ref_offsets[first]:self.user_ref_offsets[last]]
+        return [self.user_ids[number] for number in set(refs)]
+
+    def day_number(self, position, tz_offset):
+        """
+        Returns which day the message at position was posted on, in a time zone, as a count of
+        days since the Unix epoch.
+
+        tz_offset: the time zone's offset from UTC, in integer seconds.
+        """
+        return (self.keys[position] // 1000000 + tz_offset) // 86400
+
+    def __add_users(self, message):
+        """
+        Record the author and mentioned users of one message.
+        Private method.
+        """
+        for user in [message['user']] + USER_MENTION.findall(message['text']):
+            number = self.__user_numbers.get(user)
+            if number is None:
+                number = len(self.user_ids)
+                self.__user_numbers[user] = number
+                self.user_ids.append(user)
+            self.user_refs.append(number)
@@ -0,0 +1,196 @@
+"""
+carmille.profiling: Opt-in profiling of individual archive jobs, for working out after the fact
+where a slow archive spent its time and memory.
+
+A profile records, per stage (history, threads, json, html, zip, upload): wall time, a cProfile
+CPU profile, and the top tracemalloc allocation growth; plus a timeline of every Slack API call
+with its latency. save() writes all of it to a bundle directory under PROFILE_DIR:
+
+  summary.json: stage timings, top functions and allocations, and the API call timeline.
+  <stage>.prof: the raw cProfile data, for pstats or snakeviz.
+
+Which jobs get profiled is set by CARMILLE_PROFILE_TEAMS and CARMILLE_PROFILE_CHANNELS (comma-
+separated Slack IDs). Note that cProfile and tracemalloc see the whole process, so anything else
+running at the same time shows up in a job's profile too.
+"""
+
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+
+PROFILE_DIR = os.environ.get('CARMILLE_PROFILE_DIR', "logs/profiles")
+
+# How many functions and allocation sites to list per stage in summary.json.
+TOP_N = 25
+
+# Only one cProfile can run at a time; overlapping profiled jobs skip the CPU profile for a stage.
+__cpu_profiler_busy = False
+
+# How many profiles are running, and whether we're the ones who turned tracemalloc on; it only
+# gets turned off again when the last of them is saved.
+__active_profiles = 0
+__started_tracemalloc = False
+
+
+def wanted(team_id, channel_id):
+    """
+    Returns True if jobs for this team or channel should be profiled.
+
+    team_id: the Slack team (workspace) identifier.
+    channel_id: the human-opaque Slack channel identifier.
+    """
+    teams = os.environ.get('CARMILLE_PROFILE_TEAMS', '').split(',')
+    channels = os.environ.get('CARMILLE_PROFILE_CHANNELS', '').split(',')
+    return bool(team_id and team_id in teams) or bool(channel_id and channel_id in channels)
+
+
+def start(job_id):
+    """
+    Begin profiling a job. Returns a profile dict to hand to stage, timed_client and save.
+
+    job_id: the job's job_id.
+    """
+    global __active_profiles, __started_tracemalloc
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        __started_tracemalloc = True
+    __active_profiles += 1
+    return {
+        'job_id': job_id,
+        'began': time.time(),
+        'began_monotonic': time.monotonic(),
+        'stages': [],
+        'api_calls': [],
+        'cpu_profiles': {},
+    }
+
+
+@contextlib.contextmanager
+def stage(profile, name):
+    """
+    Context manager that profiles everything inside it as one stage. Does nothing if profile is None.
+
+    profile: a profile dict as made by start, or None.
+    name: the stage's name.
+    """
+    global __cpu_profiler_busy
+    if profile is None:
+        yield
+        return
+
+    cpu_profiler = None
+    if not __cpu_profiler_busy:
+        cpu_profiler = cProfile.Profile()
+        __cpu_profiler_busy = True
+        cpu_profiler.enable()
+    # Something else may have turned tracemalloc off; then there's just no allocation data.
+    snapshot_before = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+    began = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - began
+        if cpu_profiler:
+            cpu_profiler.disable()
+            __cpu_profiler_busy = False
+            profile['cpu_profiles'][name] = cpu_profiler
+        growth = []
+        if snapshot_before and tracemalloc.is_tracing():
+            growth = tracemalloc.take_snapshot().compare_to(snapshot_before, 'lineno')[:TOP_N]
+        profile['stages'].append({
+            'stage': name,
+            'offset': began - profile['began_monotonic'],
+            'seconds': seconds,
+            'top_functions': __top_functions(cpu_profiler) if cpu_profiler else None,
+            'top_allocations': [str(stat) for stat in growth],
+        })
+
+
+def timed_client(client, profile):
+    """
+    Wrap a Slack client so every API call through it is recorded in the profile's timeline.
+    Returns client unchanged if profile is None.
+
+    client: a slack_sdk AsyncWebClient.
+    profile: a profile dict as made by start, or None.
+    """
+    if profile is None:
+        return client
+    return __TimedClient(client, profile)
+
+
+def save(profile):
+    """
+    Write a profile's bundle to disk. Returns the bundle's directory.
+
+    profile: a profile dict as made by start.
+    """
+    global __active_profiles, __started_tracemalloc
+    __active_profiles -= 1
+    if __active_profiles == 0 and __started_tracemalloc:
+        tracemalloc.stop()
+        __started_tracemalloc = False
+
+    directory = os.path.join(PROFILE_DIR, f"{time.strftime('%Y-%m-%d-%H-%M-%S', time.gmtime(profile['began']))}_{profile['job_id']}")
+    os.makedirs(directory, exist_ok=True)
+    for name, cpu_profiler in profile['cpu_profiles'].items():
+        cpu_profiler.dump_stats(os.path.join(directory, f"{name}.prof"))
+    with open(os.path.join(directory, "summary.json"), "w") as file:
+        json.dump({
+            'job_id': profile['job_id'],
+            'began': profile['began'],
+            'seconds': time.monotonic() - profile['began_monotonic'],
+            'stages': profile['stages'],
+            'api_calls': profile['api_calls'],
+        }, file, indent=4)
+    logging.info(f"Saved profile for job {profile['job_id']} to {directory}.")
+    return directory
+
+
+def __top_functions(cpu_profiler):
+    """
+    Returns the TOP_N functions by cumulative time from a cProfile, as pstats prints them.
+    Private function.
+    """
+    output = io.StringIO()
+    pstats.Stats(cpu_profiler, stream=output).sort_stats('cumulative').print_stats(TOP_N)
+    return output.getvalue().splitlines()
+
+
+class __TimedClient:
+    """
+    Stands in for a Slack client, passing every call through and timing the async ones.
+    Private class.
+    """
+
+    def __init__(self, client, profile):
+        self.__client = client
+        self.__profile = profile
+
+    def __getattr__(self, name):
+        attribute = getattr(self.__client, name)
+        if not callable(attribute):
+            return attribute
+        profile = self.__profile
+
+        async def timed(*args, **kwargs):
+            began = time.monotonic()
+            ok = False
+            try:
+                res = await attribute(*args, **kwargs)
+                ok = True
+                return res
+            finally:
+                profile['api_calls'].append({
+                    'method': name,
+                    'offset': began - profile['began_monotonic'],
+                    'seconds': time.monotonic() - began,
+                    'ok': ok,
+                })
+        return timed
@@ -1,18 +1,9 @@
 #!/usr/bin/env bash
 
-CONFIGPATH=/home/ussjoin/carmille-cron/carmille-s3cfg
+# Deletes archives more than an hour old, using carmille.expire.
+# Needs S3_API_ENDPOINT, S3_BUCKET, S3_ACCESS_KEY and S3_SECRET_KEY set in the environment,
+# and CARMILLE_SRC pointing at a checkout of Carmille with its requirements installed.
 
-now=$(date "+%s")
-beforetime=$(expr $now - 3600)
+CARMILLE_SRC=${CARMILLE_SRC:-/home/ussjoin/carmille}
 
-s3cmd -c $CONFIGPATH ls s3://carmille | while IFS= read -r line; do
-  datestr=$(echo $line | cut -f 1,2 -d' ')
-  filename=$(echo $line | cut -f 4 -d' ')
-  lineepoch=$(date --date="$datestr" "+%s")
-  if [ $lineepoch -ge $beforetime ]
-  then
-    echo "Not deleting $filename"
-  else
-    s3cmd -c $CONFIGPATH rm $filename
-  fi
-done
+cd "$CARMILLE_SRC" && python3 -m carmille.expire --max-age 3600
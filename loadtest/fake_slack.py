@@ -0,0 +1,108 @@
+"""
+fake_slack: A local stand-in for the parts of the Slack Web API (and S3) that Carmille uses,
+for load testing.
+
+It serves:
+  /api/<method>: auth.test, api.test, users.info, conversations.history and conversations.replies,
+    over a made-up channel of evenly spaced messages, every THREAD_EVERY-th of which has replies.
+  /respond/<request_id>: stands in for response_urls, and records what Carmille says to each.
+  Everything else: stands in for the S3 bucket, and accepts whatever is uploaded to it.
+
+Every Slack API call waits `latency` seconds first, roughly like the real thing.
+"""
+
+import asyncio
+import time
+
+from aiohttp import web
+
+# Every this-many messages is the top of a thread.
+THREAD_EVERY = 10
+# How many replies each thread gets.
+REPLIES_PER_THREAD = 3
+
+
+def make_app(start_epoch, end_epoch, messages, latency, responses):
+    """
+    Build the fake's aiohttp app.
+
+    start_epoch, end_epoch: the window, in Unix seconds, the fake channel's messages are spread over.
+    messages: how many top-level messages the fake channel has.
+    latency: how long, in seconds, each Slack API call takes.
+    responses: a dict that each response_url POST is recorded into, as
+        request_id: [(time.monotonic(), text), ...] .
+    """
+    # Newest first, the way conversations.history returns them.
+    spacing = (end_epoch - start_epoch) / (messages + 1)
+    channel = []
+    for index in range(messages):
+        ts = f"{start_epoch + (index + 1) * spacing:.6f}"
+        message = {'type': 'message', 'ts': ts, 'user': f"U{index % 20:04}", 'text': f"Message {index}, hello <@U{(index + 1) % 20:04}>!"}
+        if index % THREAD_EVERY == 0:
+            message['thread_ts'] = ts
+            message['reply_count'] = REPLIES_PER_THREAD
+        channel.append(message)
+    channel.reverse()
+    by_ts = {message['ts']: message for message in channel}
+
+    async def api(request):
+        await asyncio.sleep(latency)
+        method = request.match_info['method']
+        params = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == 'application/json':
+                params.update(await request.json())
+            else:
+                params.update(await request.post())
+
+        if method in ('auth.test', 'api.test'):
+            return web.json_response({'ok': True, 'user_id': 'UBOT', 'bot_id': 'BFAKE', 'team_id': 'TFAKE', 'team': 'Fake', 'url': 'https://fake.slack.com/'})
+        if method == 'users.info':
+            user = params.get('user')
+            return web.json_response({'ok': True, 'user': {'id': user, 'tz_offset': 0, 'profile': {'display_name_normalized': f"user-{user}", 'image_72': ''}}})
+        if method == 'conversations.history':
+            oldest = float(params.get('oldest', 0))
+            latest = float(params.get('latest', time.time()))
+            matching = [message for message in channel if oldest <= float(message['ts']) <= latest]
+            return __page(matching, params)
+        if method == 'conversations.replies':
+            parent = by_ts.get(params.get('ts'))
+            if parent is None:
+                return web.json_response({'ok': False, 'error': 'thread_not_found'})
+            replies = [dict(parent)]
+            for index in range(REPLIES_PER_THREAD):
+                replies.append({'type': 'message', 'ts': f"{float(parent['ts']) + (index + 1) / 1000:.6f}", 'thread_ts': parent['ts'], 'user': parent['user'], 'text': f"Reply {index}"})
+            return __page(replies, params)
+        return web.json_response({'ok': False, 'error': 'unknown_method'})
+
+    async def respond(request):
+        body = await request.json()
+        responses.setdefault(request.match_info['request_id'], []).append((time.monotonic(), body.get('text', '')))
+        return web.Response(text="ok")
+
+    async def s3(request):
+        await request.read()
+        return web.Response(headers={'ETag': '"fake"'})
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_route('*', '/api/{method}', api)
+    app.router.add_post('/respond/{request_id}', respond)
+    app.router.add_route('*', '/{tail:.*}', s3)
+    return app
+
+
+def __page(messages, params):
+    """
+    Return one page of messages, paginated the way Slack does it.
+    Private function.
+    """
+    limit = int(params.get('limit', 100))
+    offset = int(params.get('cursor') or 0)
+    page = messages[offset:offset + limit]
+    has_more = offset + limit < len(messages)
+    return web.json_response({
+        'ok': True,
+        'messages': page,
+        'has_more': has_more,
+        'response_metadata': {'next_cursor': str(offset + limit) if has_more else ''},
+    })
@@ -0,0 +1,266 @@
+"""
+Load tests Carmille's Bolt endpoint against a fake Slack.
+
+Starts loadtest/fake_slack.py, starts Carmille (main.py) in a scratch directory pointed at it, then
+sends correctly signed `/carmille` slash commands and "Archive!" button clicks at increasing
+concurrency. For each concurrency level it reports p50/p99 ack latency, how many acks missed
+Slack's 3-second deadline, how long archive jobs took from click to "This archive is done",
+and error rates.
+
+    python3 loadtest/run.py --levels 1,2,4,8,16 --duration 20
+
+Use --workers to try the multi-worker mode. Everything stays on this machine; nothing is sent
+to the real Slack or S3.
+"""
+
+import argparse
+import asyncio
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import aiohttp
+from aiohttp import web
+
+import fake_slack
+
+SIGNING_SECRET = "loadtest-signing-secret"
+TEAM_ID = "TFAKE"
+CHANNEL_ID = "CFAKE"
+# Slack gives up on an ack after this many seconds.
+ACK_DEADLINE = 3.0
+# The archive window every click asks for, in UTC (Carmille is started with TZ=UTC).
+WINDOW_START = datetime.datetime(2021, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)
+WINDOW_END = datetime.datetime(2021, 1, 1, 1, 0, tzinfo=datetime.timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test Carmille against a fake Slack.")
+    parser.add_argument('--levels', default="1,2,4,8,16", help="Comma-separated concurrency levels to ramp through. (Default: 1,2,4,8,16)")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds to send requests for at each level. (Default: 20)")
+    parser.add_argument('--settle', type=float, default=120, help="Seconds to wait for outstanding archive jobs after each level. (Default: 120)")
+    parser.add_argument('--click-fraction', type=float, default=0.5, help="Fraction of requests that are Archive! clicks rather than /carmille. (Default: 0.5)")
+    parser.add_argument('--messages', type=int, default=500, help="Messages in the fake channel's archive window. (Default: 500)")
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds each fake Slack API call takes. (Default: 0.05)")
+    parser.add_argument('--workers', type=int, default=1, help="CARMILLE_WORKERS for the Carmille under test. (Default: 1)")
+    parser.add_argument('--fake-port', type=int, default=8900, help="Port for the fake Slack. (Default: 8900)")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+async def run(args):
+    responses = {}
+    fake = web.AppRunner(fake_slack.make_app(WINDOW_START.timestamp(), WINDOW_END.timestamp(), args.messages, args.latency, responses), access_log=None)
+    await fake.setup()
+    await web.TCPSite(fake, "127.0.0.1", args.fake_port).start()
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+
+    workdir = tempfile.mkdtemp(prefix="carmille-loadtest-")
+    carmille = start_carmille(workdir, fake_url, args.workers)
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_until_ready(session, carmille)
+            print(f"{'conc':>5} {'reqs':>6} {'p50 ack':>8} {'p99 ack':>8} {'>3s':>5} {'err%':>6} {'jobs':>5} {'done':>5} {'p50 job':>8} {'p99 job':>8} {'job err':>7}")
+            for level in [int(level) for level in args.levels.split(',')]:
+                result = await run_level(session, args, fake_url, responses, level)
+                print(f"{level:>5} {result['requests']:>6} {result['p50_ack']:>7.3f}s {result['p99_ack']:>7.3f}s {result['late_acks']:>5} {result['error_rate'] * 100:>5.1f}% "
+                    f"{result['jobs']:>5} {result['jobs_done']:>5} {result['p50_job']:>7.2f}s {result['p99_job']:>7.2f}s {result['job_errors']:>7}")
+    finally:
+        carmille.terminate()
+        carmille.wait()
+        await fake.cleanup()
+    print(f"Carmille's log is in {workdir}/carmille.log.")
+
+
+def start_carmille(workdir, fake_url, workers):
+    """
+    Start main.py in workdir, installed into the fake team and pointed at the fake Slack and S3.
+    Returns the subprocess.Popen.
+    """
+    from slack_sdk.oauth.installation_store import FileInstallationStore, Installation
+
+    os.makedirs(os.path.join(workdir, "data"))
+    os.makedirs(os.path.join(workdir, "tmp"))
+    FileInstallationStore(base_dir=os.path.join(workdir, "data")).save(Installation(
+        app_id="AFAKE", team_id=TEAM_ID, user_id="UINSTALLER",
+        bot_token="xoxb-fake", bot_id="BFAKE", bot_user_id="UBOT"))
+
+    env = dict(os.environ,
+        TZ="UTC",
+        SLACK_API_URL=f"{fake_url}/api/",
+        SLACK_CLIENT_ID="fake", SLACK_CLIENT_SECRET="fake", SLACK_SIGNING_SECRET=SIGNING_SECRET,
+        S3_API_ENDPOINT=fake_url, S3_BUCKET="carmille", S3_ACCESS_KEY="fake", S3_SECRET_KEY="fake",
+        S3_WEBSITE_PREFIX=f"{fake_url}/carmille",
+        CARMILLE_WORKERS=str(workers))
+    main_py = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+    log = open(os.path.join(workdir, "carmille.log"), "w")
+    return subprocess.Popen([sys.executable, main_py], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_until_ready(session, carmille, timeout=60):
+    """
+    Wait for Carmille's /ready to say so.
+    """
+    give_up = time.monotonic() + timeout
+    while time.monotonic() < give_up:
+        if carmille.poll() is not None:
+            sys.exit("Carmille exited during startup; see its log.")
+        try:
+            async with session.get("http://127.0.0.1:8000/ready") as res:
+                if res.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.25)
+    sys.exit("Carmille didn't become ready in time; see its log.")
+
+
+async def run_level(session, args, fake_url, responses, level):
+    """
+    Send requests from `level` concurrent senders for args.duration seconds, then wait up to
+    args.settle seconds for the archive jobs they started. Returns a dict of results.
+    """
+    acks = []
+    errors = 0
+    clicks = {}
+    stop_at = time.monotonic() + args.duration
+
+    async def sender():
+        nonlocal errors
+        while time.monotonic() < stop_at:
+            request_id = f"{level}-{random.getrandbits(64):016x}"
+            response_url = f"{fake_url}/respond/{request_id}"
+            is_click = random.random() < args.click_fraction
+            body = block_action_body(response_url) if is_click else slash_command_body(response_url)
+            began = time.monotonic()
+            try:
+                async with session.post("http://127.0.0.1:8000/slack/events", data=body, headers=signed_headers(body)) as res:
+                    await res.read()
+                    ok = res.status == 200
+            except aiohttp.ClientError:
+                ok = False
+            acks.append(time.monotonic() - began)
+            if not ok:
+                errors += 1
+            elif is_click:
+                clicks[request_id] = began
+
+    await asyncio.gather(*[sender() for _ in range(level)])
+
+    # Wait for the jobs to finish, or for settle to run out.
+    give_up = time.monotonic() + args.settle
+    while time.monotonic() < give_up and any(__job_outcome(responses.get(request_id, [])) is None for request_id in clicks):
+        await asyncio.sleep(0.5)
+
+    job_times = []
+    job_errors = 0
+    for request_id, began in clicks.items():
+        outcome = __job_outcome(responses.get(request_id, []))
+        if outcome is None:
+            continue
+        finished, succeeded = outcome
+        if succeeded:
+            job_times.append(finished - began)
+        else:
+            job_errors += 1
+
+    return {
+        'requests': len(acks),
+        'p50_ack': __percentile(acks, 50),
+        'p99_ack': __percentile(acks, 99),
+        'late_acks': sum(1 for ack in acks if ack > ACK_DEADLINE),
+        'error_rate': errors / len(acks) if acks else 0.0,
+        'jobs': len(clicks),
+        'jobs_done': len(job_times),
+        'p50_job': __percentile(job_times, 50),
+        'p99_job': __percentile(job_times, 99),
+        'job_errors': job_errors,
+    }
+
+
+def slash_command_body(response_url):
+    """
+    Returns the form-encoded body of a `/carmille` slash command.
+    """
+    return urllib.parse.urlencode({
+        'token': "fake", 'team_id': TEAM_ID, 'team_domain': "fake",
+        'channel_id': CHANNEL_ID, 'channel_name': "loadtest",
+        'user_id': "ULOADTEST", 'user_name': "loadtest",
+        'command': "/carmille", 'text': "", 'api_app_id': "AFAKE",
+        'response_url': response_url, 'trigger_id': "1.2.3",
+    })
+
+
+def block_action_body(response_url):
+    """
+    Returns the form-encoded body of an "Archive!" button click, asking for WINDOW_START to WINDOW_END.
+    """
+    def picked(block_id, kind, key, value):
+        return {block_id: {block_id: {'type': kind, key: value}}}
+
+    values = {}
+    values.update(picked('start-date', 'datepicker', 'selected_date', WINDOW_START.strftime('%Y-%m-%d')))
+    values.update(picked('start-time', 'timepicker', 'selected_time', WINDOW_START.strftime('%H:%M')))
+    values.update(picked('end-date', 'datepicker', 'selected_date', WINDOW_END.strftime('%Y-%m-%d')))
+    values.update(picked('end-time', 'timepicker', 'selected_time', WINDOW_END.strftime('%H:%M')))
+    payload = {
+        'type': "block_actions", 'token': "fake", 'api_app_id': "AFAKE", 'trigger_id': "1.2.3",
+        'team': {'id': TEAM_ID, 'domain': "fake"},
+        'user': {'id': "ULOADTEST", 'username': "loadtest", 'team_id': TEAM_ID},
+        'channel': {'id': CHANNEL_ID, 'name': "loadtest"},
+        'container': {'type': "message", 'channel_id': CHANNEL_ID, 'is_ephemeral': True},
+        'response_url': response_url,
+        'actions': [{'type': "button", 'action_id': "make_archive", 'block_id': "archive", 'value': "make_archive", 'action_ts': f"{time.time():.6f}"}],
+        'state': {'values': values},
+    }
+    return urllib.parse.urlencode({'payload': json.dumps(payload)})
+
+
+def signed_headers(body):
+    """
+    Returns the headers Slack would send with body, signed with SIGNING_SECRET.
+    """
+    timestamp = str(int(time.time()))
+    signature = hmac.new(SIGNING_SECRET.encode(), f"v0:{timestamp}:{body}".encode(), hashlib.sha256).hexdigest()
+    return {
+        'Content-Type': "application/x-www-form-urlencoded",
+        'X-Slack-Request-Timestamp': timestamp,
+        'X-Slack-Signature': f"v0={signature}",
+    }
+
+
+def __job_outcome(posted):
+    """
+    Given what Carmille posted to a click's response_url, returns (when, succeeded) once the job
+    has finished one way or another, or None if it hasn't yet.
+    Private function.
+    """
+    for when, text in posted:
+        if "This archive is done" in text:
+            return (when, "failed" not in text)
+        if "Unfortunately" in text or "narrower range" in text:
+            return (when, False)
+    return None
+
+
+def __percentile(values, percentile):
+    """
+    Returns the nearest-rank percentile of values, or 0.0 if there aren't any.
+    Private function.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(percentile / 100 * len(ordered)) - 1))]
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,25 @@
 import time
+# Measure how long everything below takes to import; reported by /ready.
+IMPORT_BEGAN = time.perf_counter()
 import os
 import sys
 import logging
+import asyncio
+import aiohttp
+import multiprocessing
+import signal
+from aiohttp import web
 # Import the async app instead of the regular one
 from slack_bolt.async_app import AsyncApp
 from slack_bolt.oauth.async_oauth_settings import AsyncOAuthSettings
 from slack_sdk.oauth.installation_store import FileInstallationStore
 from slack_sdk.oauth.state_store import FileOAuthStateStore
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk.webhook.async_client import AsyncWebhookClient
 import carmille
 
+IMPORT_SECONDS = time.perf_counter() - IMPORT_BEGAN
+
 logging.basicConfig(level=logging.INFO)
 
 oauth_settings = AsyncOAuthSettings(
@@ -21,9 +32,53 @@ oauth_settings = AsyncOAuthSettings(
 
 app = AsyncApp(
     signing_secret=os.environ["SLACK_SIGNING_SECRET"],
-    oauth_settings=oauth_settings
+    oauth_settings=oauth_settings,
+    # SLACK_API_URL is only for pointing Carmille at a fake Slack, like the one in loadtest/.
+    client=AsyncWebClient(base_url=os.environ.get('SLACK_API_URL', AsyncWebClient.BASE_URL))
 )
 
+# How many HTTP worker processes to run. They share port 8000 and the job store.
+WORKERS = int(os.environ.get('CARMILLE_WORKERS', 1))
+# How many archive jobs each worker process runs at once.
+JOBS_PER_WORKER = int(os.environ.get('CARMILLE_JOBS_PER_WORKER', 4))
+# How many low-priority (big) archive jobs each worker runs at once, out of JOBS_PER_WORKER.
+LOW_PRIORITY_JOBS_PER_WORKER = 1
+# Archives estimated at more than this many messages, counting thread replies, go in the low-priority lane...
+LOW_PRIORITY_OVER = int(os.environ.get('CARMILLE_LOW_PRIORITY_OVER', 20000))
+# ...and ones over this many get turned away, with a request to pick a narrower range.
+TOO_BIG_OVER = int(os.environ.get('CARMILLE_TOO_BIG_OVER', 250000))
+# Whether archives spanning several days get each day delivered as soon as it's ready.
+PROGRESSIVE = os.environ.get('CARMILLE_PROGRESSIVE', '1') != '0'
+# Progress messages per archive, on top of "received" and "done"; Slack allows five per response_url.
+MAX_PROGRESS_UPDATES = 2
+# Minimum seconds between progress messages after the first, so ready days get batched together.
+PROGRESS_UPDATE_INTERVAL = 300
+# How often, in seconds, an idle worker checks the job store for work enqueued by another worker.
+JOB_POLL_INTERVAL = 2
+
+# How this worker's startup went, reported by /ready.
+startup_stats = {
+    'ready': False,
+    'import_seconds': IMPORT_SECONDS,
+    'prewarm_seconds': None,
+    'first_request_seconds': None,
+}
+
+# Set whenever this worker enqueues a job, so its runner picks it up without waiting for a poll.
+# Made on startup, inside the worker's event loop.
+job_wakeup = None
+
+
+@app.middleware
+async def track_first_request(next):
+    # Time the first request this worker handles, from Bolt getting it to our ack.
+    if startup_stats['first_request_seconds'] is not None:
+        return await next()
+    began = time.perf_counter()
+    response = await next()
+    startup_stats['first_request_seconds'] = time.perf_counter() - began
+    logging.info(f"First request handled in {startup_stats['first_request_seconds']:.3f}s.")
+    return response
 
 @app.command("/carmille")
 async def command(context, ack, body, respond):
@@ -89,15 +144,270 @@ async def action_make_archive(context, body, ack, respond):
     channel_id = body['channel']['id']
     channel_name = body['channel']['name']
 
-    await respond(text=f"I've received your request! I'll archive channel *#{channel_name}* from *{time.strftime('%Y-%m-%d %H:%M',start_time)}* to *{time.strftime('%Y-%m-%d %H:%M',end_time)}*, all times local to you. Exciting!")
-    message_archive_url = await carmille.fetch.get_message_archive(context.client, channel_id, channel_name, start_time, end_time, user_tz_offset)
-    await respond(text=f"This archive is done, and you can pick it up at `{message_archive_url}`. Have a nice day!")
+    # Before committing to anything, work out roughly how big this is going to be.
+    try:
+        estimate = await carmille.estimate.estimate_archive(context.client, channel_id, start_time, end_time)
+        decision = carmille.estimate.admission(estimate, LOW_PRIORITY_OVER, TOO_BIG_OVER)
+    except Exception as error:
+        # Not being able to size it up is no reason not to try.
+        logging.exception(error)
+        estimate = None
+        decision = carmille.estimate.ADMIT
+
+    window = f"channel *#{channel_name}* from *{time.strftime('%Y-%m-%d %H:%M',start_time)}* to *{time.strftime('%Y-%m-%d %H:%M',end_time)}*"
+
+    if decision == carmille.estimate.TOO_BIG:
+        await respond(text=f"Archiving {window} would come to {carmille.estimate.describe(estimate)}, which is more than I can take on. Could you pick a narrower range and try again?")
+        return
+
+    # Checkpoint the job, so that if we get restarted partway through, we can pick it back up.
+    low_priority = decision == carmille.estimate.LOW_PRIORITY
+    job = carmille.checkpoint.new_job(context.team_id, context.enterprise_id, context.is_enterprise_install,
+        body['response_url'], channel_id, channel_name, time.mktime(start_time), time.mktime(end_time), user_tz_offset, low_priority,
+        carmille.profiling.wanted(context.team_id, channel_id))
+
+    if low_priority:
+        await respond(text=f"I've received your request! I'll archive {window}, all times local to you. That'll be {carmille.estimate.describe(estimate)}, so it's going to take a while, and it'll wait its turn behind smaller archives.")
+    else:
+        await respond(text=f"I've received your request! I'll archive {window}, all times local to you. Exciting!")
+
+    # Hand it to whichever worker gets to it first; more often than not, that's us.
+    # (SQLite can wait on other workers' locks, so keep it off the event loop like the other job store calls.)
+    await asyncio.get_running_loop().run_in_executor(None, carmille.jobstore.enqueue, job['job_id'], low_priority)
+    job_wakeup.set()
+
+async def run_job(job, reclaimed):
+    """
+    Run a checkpointed archive job, and tell the original requester about it through the
+    job's response_url when it's done.
+
+    job: a job dict from carmille.checkpoint.
+    reclaimed: True if another process had already started on this job before it went away.
+    """
+    logging.info(f"{'Resuming' if reclaimed else 'Starting'} archive job {job['job_id']} for channel #{job['channel_name']}.")
+    installation = await oauth_settings.installation_store.async_find_installation(
+        enterprise_id=job['enterprise_id'], team_id=job['team_id'], is_enterprise_install=job['is_enterprise_install'])
+    if installation is None or not installation.bot_token:
+        logging.error(f"No installation found for job {job['job_id']}; dropping it.")
+        return
+    client = AsyncWebClient(token=installation.bot_token, base_url=app.client.base_url, session=app.client.session)
+    # The window was stored as Unix seconds; localtime() round-trips through the mktime() calls downstream.
+    start_time = time.localtime(job['start_epoch'])
+    end_time = time.localtime(job['end_epoch'])
+    # Jobs for the teams and channels in CARMILLE_PROFILE_TEAMS and CARMILLE_PROFILE_CHANNELS get profiled.
+    profile = carmille.profiling.start(job['job_id']) if job.get('profile') else None
+    on_slice = progress_poster(job) if PROGRESSIVE else None
+    try:
+        message_archive_url = await carmille.fetch.get_message_archive(client, job['channel_id'], job['channel_name'], start_time, end_time, job['tz_offset'], job, profile, on_slice)
+    finally:
+        if profile:
+            carmille.profiling.save(profile)
+    apology = "Sorry for the wait; I had to restart partway through. " if reclaimed else ""
+    await AsyncWebhookClient(job['response_url'], session=app.client.session).send(text=f"{apology}This archive is done, and you can pick it up at `{message_archive_url}`. Have a nice day!")
+
+def progress_poster(job):
+    """
+    Returns an on_slice function for carmille.fetch.get_message_archive that tells the requester
+    about the days of their archive that are ready, while the rest is still going.
+
+    A response_url only takes five messages, so this posts at most MAX_PROGRESS_UPDATES of them,
+    at least PROGRESS_UPDATE_INTERVAL seconds apart after the first. Each one is a single slice
+    of every day finished since the last, only archived once it's time to post it, so there's
+    never an early upload that nobody hears about. (Whatever's left is in the full archive.)
+    """
+    async def on_slice(publish):
+        if job['progress_updates'] >= MAX_PROGRESS_UPDATES:
+            return False
+        if job['progress_updates'] and time.time() - job['last_progress_update'] < PROGRESS_UPDATE_INTERVAL:
+            # Not yet; the days ready by then will go together.
+            return True
+        published = await publish()
+        if published is None:
+            return True
+        label, url = published
+        await AsyncWebhookClient(job['response_url'], session=app.client.session).send(
+            text=f"While you wait for the rest, here's *{label}*, ready now: `{url}`")
+        job['progress_updates'] += 1
+        job['last_progress_update'] = time.time()
+        carmille.checkpoint.save(job)
+        return job['progress_updates'] < MAX_PROGRESS_UPDATES
+
+    return on_slice
+
+async def give_up_on(job_id):
+    """
+    Tell the requester a job has failed for good, and throw away its checkpoint.
+
+    job_id: the job's job_id. It should already be out of the job store.
+    """
+    job = carmille.checkpoint.load(job_id)
+    if job is None:
+        return
+    try:
+        await AsyncWebhookClient(job['response_url'], session=app.client.session).send(text="Unfortunately, the archive failed. Look at the logs. Sorry!")
+    except Exception as error:
+        logging.exception(error)
+    finally:
+        carmille.checkpoint.finish(job)
+
+async def run_jobs_forever():
+    """
+    Claim jobs from the shared job store and run them, up to JOBS_PER_WORKER at a time, forever.
+    At most LOW_PRIORITY_JOBS_PER_WORKER of those can be low-priority, so big archives can't
+    crowd out small ones.
+    """
+    loop = asyncio.get_running_loop()
+    running = set()
+    running_low_priority = set()
+    # job_id: the task running it.
+    tasks = {}
+    slots = asyncio.Semaphore(JOBS_PER_WORKER)
+
+    async def run_one(job_id, reclaimed):
+        job = carmille.checkpoint.load(job_id)
+        try:
+            if job:
+                await run_job(job, reclaimed)
+                carmille.checkpoint.finish(job)
+            await loop.run_in_executor(None, carmille.jobstore.complete, job_id)
+        except Exception as error:
+            logging.exception(error)
+            # Unless it's out of retries, leave the checkpoint alone so the next attempt can use it.
+            if not await loop.run_in_executor(None, carmille.jobstore.fail, job_id):
+                await give_up_on(job_id)
+        finally:
+            running.discard(job_id)
+            running_low_priority.discard(job_id)
+            tasks.pop(job_id, None)
+            slots.release()
+
+    async def heartbeat_forever():
+        while True:
+            await asyncio.sleep(carmille.jobstore.STALE_AFTER / 4)
+            try:
+                lost = await loop.run_in_executor(None, carmille.jobstore.heartbeat, list(running))
+            except Exception as error:
+                logging.exception(error)
+                continue
+            # If another worker has taken a job over (because we were stuck for too long), stop
+            # ours, so the two of us aren't both writing its checkpoint and telling the requester.
+            for job_id in lost:
+                task = tasks.get(job_id)
+                if task:
+                    logging.warning(f"Job {job_id} was taken over by another worker; stopping it here.")
+                    task.cancel()
+
+    asyncio.ensure_future(heartbeat_forever())
+
+    while True:
+        await slots.acquire()
+        job_wakeup.clear()
+        try:
+            low_priority_ok = len(running_low_priority) < LOW_PRIORITY_JOBS_PER_WORKER
+            claimed = await loop.run_in_executor(None, carmille.jobstore.claim, set(running), low_priority_ok)
+        except Exception as error:
+            logging.exception(error)
+            claimed = None
+        if claimed is None:
+            slots.release()
+            try:
+                await asyncio.wait_for(job_wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        job_id, reclaimed, low_priority, gave_up = claimed
+        if gave_up:
+            slots.release()
+            asyncio.ensure_future(give_up_on(job_id))
+            continue
+        running.add(job_id)
+        if low_priority:
+            running_low_priority.add(job_id)
+        tasks[job_id] = asyncio.ensure_future(run_one(job_id, reclaimed))
+
+async def start_job_runner(web_app):
+    global job_wakeup
+    job_wakeup = asyncio.Event()
+    # Any checkpointed job that never made it into the job store (say, we died right after
+    # checkpointing it) gets enqueued now. Jobs already in there are left alone.
+    loop = asyncio.get_running_loop()
+    for job in carmille.checkpoint.load_pending():
+        await loop.run_in_executor(None, carmille.jobstore.enqueue, job['job_id'], job.get('low_priority', False))
+    asyncio.ensure_future(run_jobs_forever())
+
+async def expire_archives_hourly(max_age):
+    """
+    Delete archives older than max_age seconds from the bucket, once an hour, forever.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            # boto3 is synchronous, so keep it off the event loop.
+            await loop.run_in_executor(None, carmille.expire.remove_old_archives, max_age)
+        except Exception as error:
+            logging.exception(error)
+        await asyncio.sleep(3600)
+
+async def start_archive_expiry(web_app):
+    EXPIRE_ARCHIVES_AFTER = os.environ.get('EXPIRE_ARCHIVES_AFTER')
+    if EXPIRE_ARCHIVES_AFTER:
+        asyncio.ensure_future(expire_archives_hourly(int(EXPIRE_ARCHIVES_AFTER)))
+
+async def start_prewarm(web_app):
+    # Share one HTTP session between every Slack client Bolt makes for us, so they all reuse
+    # the connections we warm up here.
+    app.client.session = aiohttp.ClientSession()
+    web_app.on_cleanup.append(stop_prewarm)
+    asyncio.ensure_future(prewarm())
+
+async def stop_prewarm(web_app):
+    await app.client.session.close()
+
+async def prewarm():
+    """
+    Get the slow parts of handling the first request out of the way in the background:
+    importing export's libraries, building the S3 client, and opening connections to S3 and Slack.
+    """
+    began = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        loop.run_in_executor(None, carmille.export.prewarm),
+        app.client.api_test(),
+        return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.warning(f"Prewarming didn't fully work: {result}")
+    startup_stats['prewarm_seconds'] = time.perf_counter() - began
+    startup_stats['ready'] = True
+    logging.info(f"Imports took {startup_stats['import_seconds']:.3f}s; prewarming took {startup_stats['prewarm_seconds']:.3f}s. Ready.")
+
+async def ready(request):
+    # 200 once prewarming is done, 503 before; either way, with the startup timings.
+    return web.json_response(startup_stats, status=200 if startup_stats['ready'] else 503)
 
 @app.error
 async def global_error_handler(error, body, logger):
     logger.exception(error)
     logger.info(body)
 
+def serve(worker_index, reuse_port=False):
+    """
+    Run one HTTP worker on port 8000, along with its share of the archive job runner.
+
+    worker_index: which worker this is, counting from 0. Worker 0 also handles archive expiry.
+    reuse_port: set SO_REUSEPORT, so several workers can listen on the same port.
+    """
+    web_app = app.server(port=8000).web_app
+    web_app.router.add_get("/ready", ready)
+    # Warm up connections in the background as soon as the server is up.
+    web_app.on_startup.append(start_prewarm)
+    # Once the server is up, start running archive jobs, including any a previous run didn't finish.
+    web_app.on_startup.append(start_job_runner)
+    # And, if asked to, take care of removing old archives ourselves instead of relying on cron.
+    if worker_index == 0:
+        web_app.on_startup.append(start_archive_expiry)
+    web.run_app(web_app, port=8000, reuse_port=reuse_port)
+
 if __name__ == "__main__":
     # Check that the S3 variables are set.
     # On app startup, the library will check for SLACK_CLIENT_ID and SLACK_CLIENT_SECRET itself.
@@ -108,4 +418,26 @@ if __name__ == "__main__":
     S3_WEBSITE_PREFIX = os.environ.get('S3_WEBSITE_PREFIX')
     if not (S3_API_ENDPOINT and S3_BUCKET and S3_ACCESS_KEY and S3_SECRET_KEY and S3_WEBSITE_PREFIX):
         sys.exit("You must set S3_API_ENDPOINT, S3_BUCKET, S3_ACCESS_KEY, S3_SECRET_KEY, S3_WEBSITE_PREFIX, SLACK_CLIENT_ID, SLACK_CLIENT_SECRET, and SLACK_SIGNING_SECRET in the environment to start this.")
-    app.start(8000)
+    if WORKERS <= 1:
+        serve(0)
+    else:
+        # Every worker listens on port 8000 with SO_REUSEPORT, so the kernel spreads incoming
+        # requests between them. Any of them that dies gets replaced.
+        workers = [None] * WORKERS
+
+        def stop_workers(signum, frame):
+            for worker in workers:
+                if worker is not None:
+                    worker.terminate()
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, stop_workers)
+        signal.signal(signal.SIGINT, stop_workers)
+
+        while True:
+            for worker_index, worker in enumerate(workers):
+                if worker is None or not worker.is_alive():
+                    if worker is not None:
+                        logging.error(f"Worker {worker_index} exited with {worker.exitcode}; restarting it.")
+                    workers[worker_index] = multiprocessing.Process(target=serve, args=(worker_index, True))
+                    workers[worker_index].start()
+            time.sleep(1)